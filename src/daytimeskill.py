@@ -1,6 +1,7 @@
 """
 Skill that evaluates the current day time
 
+Daytime enumerates the phases of a day
 DaytimeState is a state data object providing information about current daytime
 DaytimeSkill is a Skill to detect the current daytime
 
@@ -8,8 +9,23 @@ Copyright (c) 2021 Timo Haeckel
 """
 
 from skills import SkillWithState
+from enum import IntEnum
 import time
-import datetime
+
+
+class Daytime(IntEnum):
+    """ The phases of a day detected by the DaytimeSkill.
+
+    The values are consecutive, so they can be used as index into a table 
+    with an entry for each phase.
+    """
+    DAY = 0
+    SUNRISE = 1
+    SUNSET = 2
+    NIGHT = 3
+
+    def __str__(self):
+        return self.name.capitalize()
 
 
 class DaytimeState():
@@ -19,40 +35,40 @@ class DaytimeState():
     ----------
     bedtime : bool
         True if it is currently bed time
-    daytime : str
+    daytime : Daytime
         one of:
-        DAY_STR = "Daytime"
-        SUNRISE_STR = "Sunrise"
-        SUNSET_STR = "Sunset"
-        NIGHT_STR = "Nighttime"
-    options : list(str)
+        Daytime.DAY
+        Daytime.SUNRISE
+        Daytime.SUNSET
+        Daytime.NIGHT
+    options : frozenset(Daytime)
         contains all valid options for daytime
     """
-    DAY_STR = "Day"
-    SUNRISE_STR = "Sunrise"
-    SUNSET_STR = "Sunset"
-    NIGHT_STR = "Night"
-    options = [DAY_STR, SUNRISE_STR, SUNSET_STR, NIGHT_STR]
+    __slots__ = ("daytime", "bedTime")
+    options = frozenset(Daytime)
 
-    def __init__(self, daytime=DAY_STR):
+    def __init__(self, daytime=Daytime.DAY):
         self.setDayTime(daytime)
         self.bedTime = False
 
     def setDayTime(self, daytime):
         if daytime in self.options:
-            self.daytime = daytime
+            self.daytime = Daytime(daytime)
+
+    def isState(self, daytime):
+        return self.daytime is daytime
 
     def isDayTime(self):
-        return self.daytime == self.DAY_STR
+        return self.daytime is Daytime.DAY
 
     def isSunriseTime(self):
-        return self.daytime == self.SUNRISE_STR
+        return self.daytime is Daytime.SUNRISE
 
     def isSunsetTime(self):
-        return self.daytime == self.SUNSET_STR
+        return self.daytime is Daytime.SUNSET
 
     def isNightTime(self):
-        return self.daytime == self.NIGHT_STR
+        return self.daytime is Daytime.NIGHT
 
     def isBedTime(self):
         return self.bedTime
@@ -80,7 +96,7 @@ class DaytimeSkill(SkillWithState):
             "monday" : "23:00-07:00",            
             "tuesday" : "23:00-07:00",
             "wednesday" : "23:00-07:00",
-            "thirsday" : "23:00-07:00",
+            "thursday" : "23:00-07:00",
             "friday" : "03:00-08:00",
             "saturday" : "03:00-08:00",
             "sunday" : "23:00-07:00"
@@ -91,8 +107,12 @@ class DaytimeSkill(SkillWithState):
 
     Attributes
     ----------
-    bedTime : dict(str, str)
-        The bedtime as described in the settings
+    bedTimeByWeekday : list(tuple(int, int))
+        The bedtime as described in the settings parsed into start and end 
+        minutes since midday of the day the night starts on, indexed by 
+        the weekday (monday is 0). None for days without bed time.
+    hasBedTime : bool
+        True if there is a bed time for at least one day
     STATE_PREFIX : str
         A prefix used to form the state key in the state data base
     WEATHER_STATE_PREFIX : str
@@ -101,7 +121,20 @@ class DaytimeSkill(SkillWithState):
         Minutes sunrise is detected after the actual sunrise
     SUNSET_PHASE_MINUTES : int
         Minutes sunset is detected before the actual sunset
+    MIDDAY : int
+        The border between two bed time days in minutes since midnight
+    MINUTES_PER_DAY : int
+        Number of minutes of a day
+    WEEKDAYS : list(str)
+        The bed time setting keys indexed by the weekday (monday is 0)
     """
+    MIDDAY = 12 * 60
+    MINUTES_PER_DAY = 24 * 60
+    WEEKDAYS = [
+        "monday", "tuesday", "wednesday", "thursday", "friday", "saturday",
+        "sunday"
+    ]
+
     def __init__(self, statedb, settingsFile=""):
         """ 
         Parameters
@@ -120,106 +153,143 @@ class DaytimeSkill(SkillWithState):
             "statePrefix", "Daytime")
         self.WEATHER_STATE_PREFIX = self.findSkillSettingWithKeyOrDefault(
             "weatherStatePrefix", "Weather")
-        self.bedTime = self.findSkillSettingWithKeyOrDefault("bedTime", dict())
+        self.bedTimeByWeekday = [None] * len(self.WEEKDAYS)
+        bedTime = self.findSkillSettingWithKeyOrDefault("bedTime", dict())
+        for day, interval in bedTime.items():
+            if day not in self.WEEKDAYS:
+                self.log("Ignoring bed time for unknown day " + day)
+                continue
+            try:
+                self.bedTimeByWeekday[self.WEEKDAYS.index(
+                    day)] = self.parseTimeInterval(interval)
+            except ValueError:
+                self.error("Ignoring invalid bed time " + str(interval) +
+                           " for " + day)
+        self.hasBedTime = any(self.bedTimeByWeekday)
         self.SUNRISE_PHASE_MINUTES = self.findSkillSettingWithKeyOrDefault(
             "sunrisePhaseMinutes", 0) * 60
         self.SUNSET_PHASE_MINUTES = self.findSkillSettingWithKeyOrDefault(
             "sunsetPhaseMinutes", 45) * 60
 
-    def checkBedTime(self):
+    def parseTimeInterval(self, interval):
+        """ 
+        Parses a bed time interval setting, e.g., "23:00-07:00".
+
+        A start time after midday is on the day the night starts on, any 
+        other start time and the end time are on the next day.
+
+        Parameters
+        ----------
+        interval : str
+            The interval in the format "HH:MM-HH:MM"
+
+        Returns
+        -------
+        tuple(int, int) : the start and end time in minutes since midday of 
+            the day the night starts on
+
+        Raises
+        ------
+        ValueError
+            If the interval is not in the format "HH:MM-HH:MM"
+        """
+        start, end = str(interval).split('-')
+        startHours, startMins = start.split(':')
+        endHours, endMins = end.split(':')
+        startMinutes = int(startHours) * 60 + int(startMins)
+        endMinutes = int(endHours) * 60 + int(endMins)
+        if startMinutes <= self.MIDDAY:
+            startMinutes += self.MINUTES_PER_DAY
+        return (startMinutes - self.MIDDAY,
+                endMinutes + self.MINUTES_PER_DAY - self.MIDDAY)
+
+    def checkBedTime(self, now):
         """ 
         Checks weather current time is in the bedTime list.
 
+        Parameters
+        ----------
+        now : float
+            The current time.time() timestamp
+
         Returns
         -------
         Bool : True if it there is a bedTime entry for now
         """
-        #helper variables
-        currentDatetime = datetime.datetime.now()
-        today = datetime.date.today()
-        yesterday = today - datetime.timedelta(days=1)
-        tomorrow = today + datetime.timedelta(days=1)
-        # check if currently before midday and alter lookupday if necessary
-        lookupday = currentDatetime.strftime("%A").lower()
-        beforeMidday = False
-        if currentDatetime < datetime.datetime.combine(
-                today, datetime.time(12, 0, 0)):
-            beforeMidday = True
-            lookupday = yesterday.strftime("%A").lower()
+        if not self.hasBedTime:
+            return False
+        currentTime = time.localtime(now)
+        # minutes since midday, the day before if currently before midday
+        lookupday = currentTime.tm_wday
+        minutes = currentTime.tm_hour * 60 + currentTime.tm_min - self.MIDDAY
+        if minutes < 0:
+            lookupday = (lookupday - 1) % 7
+            minutes += self.MINUTES_PER_DAY
         # find todays entry from list with 12 to 12 wrap
-        if len(self.bedTime) > 0 and lookupday in self.bedTime:
-            # there is an entry for today!
-            # prepare the settings data
-            interval = self.bedTime[lookupday].split('-')
-            startSplit = interval[0].split(':')
-            endSplit = interval[1].split(':')
-            startTime = datetime.time(int(startSplit[0]), int(startSplit[1]))
-            endTime = datetime.time(int(endSplit[0]), int(endSplit[1]))
-            # find out for which day start and end time are ment?!
-            if beforeMidday:
-                endTime = datetime.datetime.combine(today, endTime)
-                if startTime > datetime.time(12, 0, 0):
-                    startTime = datetime.datetime.combine(yesterday, startTime)
-                else:
-                    startTime = datetime.datetime.combine(today, startTime)
-            else:
-                endTime = datetime.datetime.combine(tomorrow, endTime)
-                if startTime > datetime.time(12, 0, 0):
-                    startTime = datetime.datetime.combine(today, startTime)
-                else:
-                    startTime = datetime.datetime.combine(tomorrow, startTime)
-            # finally compare the times
-            if currentDatetime >= startTime and currentDatetime < endTime:
-                # we should be sleeping!
-                return True
+        entry = self.bedTimeByWeekday[lookupday]
+        if entry is not None:
+            # there is an entry for today, are we inside?
+            return entry[0] <= minutes < entry[1]
         # no bed time entry for the current time
         return False
 
-    def getDayTime(self):
+    def getDayTime(self, now):
         """ 
         Checks current daytime based on the weather information.
 
+        Parameters
+        ----------
+        now : float
+            The current time.time() timestamp
+
         Returns
         -------
-        str : one of DaytimeState.options
+        Daytime : one of DaytimeState.options
         """
         weather = self.readState(self.WEATHER_STATE_PREFIX)
         if weather is None:
             self.log("No weather information --> Day")
-            return DaytimeState.DAY_STR
+            return Daytime.DAY
 
-        now = time.time()
         if now >= (weather.getSunriseTime() +
                    self.SUNRISE_PHASE_MINUTES) and now <= (
                        weather.getSunsetTime() - self.SUNSET_PHASE_MINUTES):
-            return DaytimeState.DAY_STR
+            return Daytime.DAY
         elif now > (weather.getSunsetTime() - self.SUNSET_PHASE_MINUTES
                     ) and now < weather.getSunsetTime():
-            return DaytimeState.SUNSET_STR
+            return Daytime.SUNSET
         elif now < (weather.getSunriseTime() + self.SUNRISE_PHASE_MINUTES
                     ) and now > weather.getSunriseTime():
-            return DaytimeState.SUNSET_STR
+            return Daytime.SUNSET
         else:
-            return DaytimeState.NIGHT_STR
+            return Daytime.NIGHT
 
-    def task(self):
+    def task(self, now=None):
         """ Detects the current daytime
 
         This skill detects whether it is day time, sunset, oder night time 
         based on the weather information from the WeatherSkill. The bed time 
         is detected based on the settings for each day. 
         The DaytimeState data object with the key STATE_PREFIX will be updated.
+
+        Parameters
+        ----------
+        now : float
+            The time.time() timestamp of the current run
         """
+        if now is None:
+            now = time.time()
         daytimeState = self.readState(self.STATE_PREFIX)
         if daytimeState is None:
             daytimeState = DaytimeState()
-        bedTime = self.checkBedTime()
+        bedTime = self.checkBedTime(now)
         daytimeState.bedTime = bedTime
-        dayTime = self.getDayTime()
+        dayTime = self.getDayTime(now)
         daytimeState.setDayTime(dayTime)
         self.updateState(self.STATE_PREFIX, daytimeState)
 
         if bedTime:
-            self.log("It is " + dayTime + " and you should be sleeping!")
+            self.log("It is " + str(dayTime) + " and you should be sleeping!")
         else:
-            self.log("It is " + dayTime + " and you should not be sleeping!")
+            self.log("It is " + str(dayTime) +
+                     " and you should not be sleeping!")
@@ -8,10 +8,86 @@ Copyright (c) 2021 Timo Haeckel
 """
 
 from skills import SkillWithState
+import os
 import platform
+import select
+import socket
+import struct
 import subprocess
+import sys
+import time
 import datetime
 
+PING_ON_WINDOWS = platform.system().lower() == 'windows'
+# only Linux rewrites the identifier of ICMP datagram sockets
+ICMP_ON_LINUX = platform.system().lower() == 'linux'
+PING_COUNT_FLAG = '-n' if PING_ON_WINDOWS else '-c'
+# wait at most one second for a reply (-w in ms on windows, -W in s else)
+PING_TIMEOUT_FLAGS = ('-w', '1000') if PING_ON_WINDOWS else ('-W', '1')
+PING_COMMAND = ('ping', PING_COUNT_FLAG, '1', *PING_TIMEOUT_FLAGS, '-4')
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = struct.Struct('!BBHHH')
+ICMP_PAYLOAD = b'PyHomeAutomate presence probe'
+# IPv4 header (max 60 bytes) and echo reply
+RECEIVE_BUFFER_SIZE = 1024
+# seconds to wait for the echo replies of all probes
+PROBE_TIMEOUT = 1.0
+# seconds until a host name is looked up again, so a new DHCP lease or a
+# name that could not be resolved is picked up
+RESOLVE_INTERVAL = 600
+
+
+def icmpChecksum(data, partialSum=0):
+    """ Computes the internet checksum of an ICMP packet (RFC 1071).
+
+    Parameters
+    ----------
+    data : bytes
+        The ICMP packet with a zero checksum field
+    partialSum : int
+        Sum of the 16 bit words of data following the given data, used to 
+        add a constant payload without summing it again
+
+    Returns
+    -------
+    int : the 16 bit checksum
+    """
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data)) + partialSum
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+# sum of the 16 bit words of the payload, added to every header checksum
+ICMP_PAYLOAD_SUM = ~icmpChecksum(ICMP_PAYLOAD) & 0xffff
+
+
+def openIcmpSocket():
+    """ Opens a socket to send ICMP echo requests.
+
+    Tries an unprivileged ICMP datagram socket first (macOS, or Linux if 
+    allowed by net.ipv4.ping_group_range) and a raw socket second.
+
+    Returns
+    -------
+    tuple(socket.socket, bool) : the socket and whether it is a raw socket,
+        (None, False) if no ICMP socket is permitted
+    """
+    for socketType in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            icmpSocket = socket.socket(socket.AF_INET, socketType,
+                                       socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+        # replies are drained until the socket would block
+        icmpSocket.setblocking(False)
+        return icmpSocket, socketType == socket.SOCK_RAW
+    return None, False
+
 
 class DevicePresenceState():
     """ State data object for the DetectDevicePresenceSkill.
@@ -22,13 +98,19 @@ class DevicePresenceState():
         The device IPv4 address.
     currentlyPresent : Boolean
         The current detection state
+    lastDetectedTime : float
+        The time the device was last detected in seconds since the epoch, 
+        None if it was never detected
     lastDetectedAt : datetime
-        The time the device was last detected
+        The time the device was last detected, converted from 
+        lastDetectedTime when read
     """
-    def __init__(self, address, currentlyPresent=False):
+    __slots__ = ("address", "currentlyPresent", "lastDetectedTime")
+
+    def __init__(self, address, currentlyPresent=False, now=None):
         """ 
-        lastDetectedAt will be automatically initialized with none if 
-        currentlyPresent is false, else to the current datetime
+        lastDetectedTime will be automatically initialized with none if 
+        currentlyPresent is false, else to the current time
 
         Parameters
         ----------
@@ -36,25 +118,37 @@ class DevicePresenceState():
             The device IPv4 address.
         currentlyPresent : Boolean (Default False)
             The current detection state
+        now : float (Default None)
+            The current time.time() timestamp, fetched if not given
         """
-        self.lastDetectedAt = None
+        self.lastDetectedTime = None
         self.address = address
-        self.setPresence(currentlyPresent)
+        self.setPresence(currentlyPresent, now)
 
-    def setPresence(self, currentlyPresent):
+    def setPresence(self, currentlyPresent, now=None):
         """ Set the current device state to the given value.
 
-        lastDetectedAt will be automatically updated with the current datetime
+        lastDetectedTime will be automatically updated with the current time
         if currentlyPresent is set to true. 
         
         Parameters
         ----------
         currentlyPresent : Boolean
             The current detection state
+        now : float (Default None)
+            The current time.time() timestamp, fetched if not given
         """
         self.currentlyPresent = currentlyPresent
         if currentlyPresent:
-            self.lastDetectedAt = datetime.datetime.now()
+            self.lastDetectedTime = time.time() if now is None else now
+
+    @property
+    def lastDetectedAt(self):
+        """ The datetime the device was last detected, None if never.
+        """
+        if self.lastDetectedTime is None:
+            return None
+        return datetime.datetime.fromtimestamp(self.lastDetectedTime)
 
 
 class DetectDevicePresenceSkill(SkillWithState):
@@ -63,13 +157,24 @@ class DetectDevicePresenceSkill(SkillWithState):
     This skill sends ping probes to the device addresses to detect their 
     presence. Remember that a host may not respond to a ping (ICMP) request
     even if the host name is valid.
+    The probes are sent from a single ICMP socket. If the process is not 
+    permitted to open one, the ping command is run for every address.
     The DevicePresenceState() with the key STATE_PREFIX+ADDRESS will be
-    constantly updated.
+    constantly updated. The addresses of all present devices are published 
+    as a frozenset with the bare key STATE_PREFIX after the first run and 
+    whenever they change, so other skills can tell who is home without 
+    reading every device state. Note that this key holds a frozenset(str), 
+    not a DevicePresenceState.
+    A device detected less than half an interval ago is not probed again. 
+    A device that does not respond is probed less often, the number of runs 
+    between its probes doubles with every miss up to maxAbsentBackoff. The 
+    default of 1 probes absent devices every run.
 
     Settings
     --------
     {
         "statePrefix" : "DevicePresence:",
+        "maxAbsentBackoff" : 1,
         "deviceAddresses" : [
             "localhost",
             "192.168.178.12"
@@ -78,12 +183,49 @@ class DetectDevicePresenceSkill(SkillWithState):
 
     Attributes
     ----------
-    addresses : list(str)
+    addresses : tuple(str)
         The device IPv4 addresses to be detected in the local network.
     STATE_PREFIX : str
         A prefix used to form the state key in the state data base with 
         STATE_PREFIX + Address  
+    stateKeys : dict(str, str)
+        The interned state key STATE_PREFIX + Address of every address
+    icmpSocket : socket.socket
+        The socket sending the probes, None if the ping command is used
+    rawSocket : bool
+        True if icmpSocket is a raw socket receiving all ICMP packets
+    checkIdentifier : bool
+        True if the replies on icmpSocket carry the identifier of the 
+        probes, False for Linux datagram sockets rewriting it
+    identifier : int
+        The ICMP identifier of the probes
+    sequence : int
+        The ICMP sequence number of the last probe sent
+    resolvedAddresses : dict(str, str)
+        The IPv4 address of every host name resolved for the icmpSocket
+    resolveAt : dict(str, float)
+        The time.monotonic() timestamp each host name is looked up again
+    requestBuffer : bytearray
+        The echo request packet, the header is rewritten for every probe
+    receiveBuffer : bytearray
+        The buffer every reply is received into
+    maxAbsentBackoff : int
+        The maximum number of runs between the probes of an absent device
+    absentBackoff : dict(str, int)
+        The current number of runs between the probes of each absent device
+    skippedProbes : dict(str, int)
+        The number of runs each absent device is not probed anymore
+    presentDevices : frozenset(str)
+        The addresses of the devices present after the last run, None 
+        before the first run
+    deviceStates : dict(str, DevicePresenceState)
+        The state of every probed device by its address, the states are 
+        owned by this skill and published to the state data base
+    MAX_PING_PROCESSES : int
+        The maximum number of ping commands running at the same time
     """
+    MAX_PING_PROCESSES = 64
+
     def __init__(self, statedb, settingsFile=""):
         """ 
         Parameters
@@ -98,33 +240,309 @@ class DetectDevicePresenceSkill(SkillWithState):
                                 name="DetectDevicePresence",
                                 statedb=statedb,
                                 settingsFile=settingsFile)
-        self.addresses = self.findSkillSettingWithKeyOrDefault(
-            "deviceAddresses", [])
+        self.addresses = tuple(
+            self.findSkillSettingWithKeyOrDefault("deviceAddresses", ()))
         self.STATE_PREFIX = self.findSkillSettingWithKeyOrDefault(
             "statePrefix", "DevicePresence:")
+        self.stateKeys = {
+            host: sys.intern(self.STATE_PREFIX + host)
+            for host in self.addresses
+        }
+        self.maxAbsentBackoff = self.findSkillSettingWithKeyOrDefault(
+            "maxAbsentBackoff", 1)
+        self.absentBackoff = dict()
+        self.skippedProbes = dict()
+        self.presentDevices = None
+        self.deviceStates = dict()
+        self.icmpSocket, self.rawSocket = openIcmpSocket()
+        self.checkIdentifier = self.rawSocket or not ICMP_ON_LINUX
+        self.identifier = os.getpid() & 0xffff
+        self.sequence = 0
+        self.resolvedAddresses = dict()
+        self.resolveAt = dict()
+        self.requestBuffer = bytearray(ICMP_HEADER.size) + ICMP_PAYLOAD
+        self.receiveBuffer = bytearray(RECEIVE_BUFFER_SIZE)
+        if self.icmpSocket is None:
+            self.log("No permission for ICMP sockets, using ping command")
+
+    def ping(self, hosts):
+        """ Runs the ping command for the hosts.
+
+        The commands for up to MAX_PING_PROCESSES hosts are started at once 
+        and waited for afterwards, so they run concurrently without a thread 
+        per host.
+
+        Parameters
+        ----------
+        hosts : list(str)
+            The device addresses to probe
+
+        Returns
+        -------
+        list(Boolean) : True for each host that responded, in host order
+        """
+        results = []
+        for start in range(0, len(hosts), self.MAX_PING_PROCESSES):
+            processes = [
+                subprocess.Popen((*PING_COMMAND, host),
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+                for host in hosts[start:start + self.MAX_PING_PROCESSES]
+            ]
+            results.extend(process.wait() == 0 for process in processes)
+        return results
+
+    def echoRequest(self, sequence):
+        """ Builds an ICMP echo request packet in requestBuffer.
+
+        Only the header is written, the checksum of the constant payload is 
+        precomputed.
+
+        Parameters
+        ----------
+        sequence : int
+            The sequence number identifying the probe
+
+        Returns
+        -------
+        bytearray : the ICMP packet, valid until the next call
+        """
+        header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self.identifier,
+                                  sequence)
+        checksum = icmpChecksum(header, ICMP_PAYLOAD_SUM)
+        ICMP_HEADER.pack_into(self.requestBuffer, 0, ICMP_ECHO_REQUEST, 0,
+                              checksum, self.identifier, sequence)
+        return self.requestBuffer
+
+    def close(self):
+        """ Closes the icmpSocket and the log file.
+        """
+        if self.icmpSocket is not None:
+            self.icmpSocket.close()
+            self.icmpSocket = None
+        SkillWithState.close(self)
+
+    def resolve(self, host):
+        """ Resolves a host name to its IPv4 address.
+
+        The address is cached, so the blocking name lookup does not delay 
+        every run. The name is looked up again after RESOLVE_INTERVAL 
+        seconds, whether it could be resolved or not. If the lookup fails, 
+        the last resolved address is kept.
+
+        Parameters
+        ----------
+        host : str
+            The device address or host name
+
+        Returns
+        -------
+        str : the IPv4 address, None if the name was never resolved
+        """
+        now = time.monotonic()
+        if now < self.resolveAt.get(host, 0):
+            return self.resolvedAddresses.get(host)
+        self.resolveAt[host] = now + RESOLVE_INTERVAL
+        try:
+            address = socket.gethostbyname(host)
+        except OSError:
+            self.error("Cannot resolve device address " + host)
+            return self.resolvedAddresses.get(host)
+        self.resolvedAddresses[host] = address
+        return address
+
+    def sendProbe(self, host, sequence):
+        """ Sends an echo request to the host.
+
+        Parameters
+        ----------
+        host : str
+            The device address to probe
+        sequence : int
+            The sequence number identifying the probe
+
+        Returns
+        -------
+        Boolean : True if the request was sent
+        """
+        address = self.resolve(host)
+        if address is None:
+            return False
+        packet = self.echoRequest(sequence)
+        try:
+            try:
+                self.icmpSocket.sendto(packet, (address, 0))
+            except BlockingIOError:
+                select.select([], [self.icmpSocket], [], PROBE_TIMEOUT)
+                self.icmpSocket.sendto(packet, (address, 0))
+        except OSError:
+            # unreachable network
+            return False
+        return True
+
+    def receiveReplies(self, pending, results):
+        """ Receives all replies waiting on the icmpSocket.
+
+        Parameters
+        ----------
+        pending : dict(int, int)
+            The host index by sequence number of the probes without reply, 
+            answered probes are removed
+        results : list(Boolean)
+            The probe results, set to True for answered probes
+        """
+        buffer = self.receiveBuffer
+        while pending:
+            try:
+                size = self.icmpSocket.recv_into(buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            offset = 0
+            if size and buffer[0] >> 4 == 4:
+                # raw sockets and macOS datagram sockets receive the IPv4
+                # header, ICMP packets never start with 0x4
+                offset = (buffer[0] & 0x0f) * 4
+            if size - offset < ICMP_HEADER.size:
+                continue
+            icmpType, _, _, identifier, sequence = ICMP_HEADER.unpack_from(
+                buffer, offset)
+            if icmpType != ICMP_ECHO_REPLY:
+                continue
+            # Linux datagram sockets only receive their own replies, the
+            # kernel replaces the identifier
+            if self.checkIdentifier and identifier != self.identifier:
+                continue
+            index = pending.pop(sequence, None)
+            if index is not None:
+                results[index] = True
+
+    def probe(self, hosts):
+        """ Sends an echo request to every host and waits for the replies.
+
+        All requests are sent back to back from the icmpSocket, the replies 
+        are collected until all hosts responded or PROBE_TIMEOUT passed. 
+        After each wakeup all replies that arrived are received at once.
+
+        Parameters
+        ----------
+        hosts : list(str)
+            The device addresses to probe
+
+        Returns
+        -------
+        list(Boolean) : True for each host that responded, in host order
+        """
+        results = [False] * len(hosts)
+        pending = dict()
+        for index, host in enumerate(hosts):
+            self.sequence = (self.sequence + 1) & 0xffff
+            if self.sendProbe(host, self.sequence):
+                pending[self.sequence] = index
+        deadline = time.monotonic() + PROBE_TIMEOUT
+        while pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            readable, _, _ = select.select([self.icmpSocket], [], [], timeout)
+            if not readable:
+                break
+            self.receiveReplies(pending, results)
+        return results
+
+    def isProbeDue(self, host, now):
+        """ Checks whether the host shall be probed in this run.
+
+        Parameters
+        ----------
+        host : str
+            The device address
+        now : float
+            The time.time() timestamp of the current run
+
+        Returns
+        -------
+        Boolean : False if the host was detected less than half an interval 
+            ago or its probe is skipped because it was absent before
+        """
+        skipped = self.skippedProbes.get(host)
+        if skipped:
+            self.skippedProbes[host] = skipped - 1
+            return False
+        deviceState = self.deviceStates.get(host)
+        if deviceState is not None and deviceState.currentlyPresent:
+            return now - deviceState.lastDetectedTime >= self.interval / 2
+        return True
+
+    def updateBackoff(self, host, present):
+        """ Updates the probe backoff of the host with its probe result.
 
-    def task(self):
+        Parameters
+        ----------
+        host : str
+            The device address
+        present : Boolean
+            True if the host responded to the probe
+        """
+        if present:
+            self.absentBackoff.pop(host, None)
+            self.skippedProbes.pop(host, None)
+        else:
+            backoff = min(
+                self.absentBackoff.get(host, 0) * 2 or 1,
+                self.maxAbsentBackoff)
+            self.absentBackoff[host] = backoff
+            self.skippedProbes[host] = backoff - 1
+
+    def task(self, now=None):
         """ Device presence detection task.
 
         This function will send ping probes to the device addresses to detect 
         their presence. Remember that a host may not respond to a ping (ICMP) 
         request even if the host name is valid.
+        The probes are sent at once and their replies collected together, so 
+        a cycle takes at most PROBE_TIMEOUT instead of a timeout per address.
+        Without an ICMP socket up to MAX_PING_PROCESSES ping commands run 
+        concurrently.
+        Only the devices returned by isProbeDue() are probed.
         The DevicePresenceState data object with the key STATE_PREFIX+ADDRESS 
-        will be updated.
+        will be updated, the set of present devices with the key STATE_PREFIX
+        if it changed. All states are updated at once after the probes.
+
+        Parameters
+        ----------
+        now : float
+            The time.time() timestamp of the current run
         """
-        for host in self.addresses:
-            param = '-n' if platform.system().lower() == 'windows' else '-c'
-            command = ['ping', param, '1', host, '-4']
-            result = subprocess.call(command,
-                                     stdout=subprocess.DEVNULL,
-                                     stderr=subprocess.DEVNULL) == 0
-            deviceState = self.readState(self.STATE_PREFIX + host)
-            if deviceState is None:
-                deviceState = DevicePresenceState(host, result)
+        if now is None:
+            now = time.time()
+        hosts = [host for host in self.addresses if self.isProbeDue(host, now)]
+        if not hosts and self.presentDevices is not None:
+            return
+        if not hosts:
+            results = []
+        elif self.icmpSocket is not None:
+            results = self.probe(hosts)
+        else:
+            results = self.ping(hosts)
+        presentDevices = set(self.presentDevices or ())
+        updates = dict()
+        for host, result in zip(hosts, results):
+            self.updateBackoff(host, result)
+            if result:
+                presentDevices.add(host)
             else:
-                deviceState.setPresence(result)
-            self.updateState(self.STATE_PREFIX + host, deviceState)
-            if result == True:
-                self.log("Device " + host + " is reachable")
+                presentDevices.discard(host)
+            deviceState = self.deviceStates.get(host)
+            if deviceState is None:
+                deviceState = DevicePresenceState(host, result, now)
+                self.deviceStates[host] = deviceState
             else:
-                self.log("Device " + host + " is unreachable")
+                deviceState.setPresence(result, now)
+            updates[self.stateKeys[host]] = deviceState
+            if not self.logSilent:
+                self.log(f"Device {host} is "
+                         f"{'reachable' if result else 'unreachable'}")
+        if presentDevices != self.presentDevices:
+            self.presentDevices = frozenset(presentDevices)
+            updates[self.STATE_PREFIX] = self.presentDevices
+        self.updateStates(updates)
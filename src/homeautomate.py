@@ -4,41 +4,80 @@ Copyright (c) 2021 Timo Haeckel
 """
 
 import statedb
+import skills
+import importlib
+import threading
 import traceback
-import time
 import datetime
-from devicedetectionskill import DetectDevicePresenceSkill
-from wheatherskill import WeatherSkill
-from daytimeskill import DaytimeSkill
-from raumfeldskill import RaumfeldTVWakeup
-from hueskill import HueDaytimeAndWeatherSkill
 
 # logFile = str(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")) + ".log"
 jsonSettingsFile = "my_skills_config.json"
-statedb = statedb.StateDataBase()
-skillList = [
-    DetectDevicePresenceSkill(statedb=statedb, settingsFile=jsonSettingsFile),
-    WeatherSkill(statedb=statedb, settingsFile=jsonSettingsFile),
-    DaytimeSkill(statedb=statedb, settingsFile=jsonSettingsFile),
-    RaumfeldTVWakeup(statedb=statedb, settingsFile=jsonSettingsFile),
-    HueDaytimeAndWeatherSkill(statedb=statedb, settingsFile=jsonSettingsFile)
+# the skill tasks only wait for I/O, a small stack for the scheduler thread
+# running them is sufficient, other threads keep the default stack size
+skillThreadStackSize = 512 * 1024
+# skills started if the settings file has no "enabledSkills" list
+defaultSkills = [
+    "devicedetectionskill.DetectDevicePresenceSkill",
+    "wheatherskill.WeatherSkill",
+    "daytimeskill.DaytimeSkill",
+    "raumfeldskill.RaumfeldTVWakeup",
+    "hueskill.HueDaytimeAndWeatherSkill"
 ]
 
 
+def loadSkills(settingsFile, stateDataBase):
+    """ Creates the skills enabled in the settings file.
+
+    The settings file lists the skills as "module.SkillClass" in 
+    "enabledSkills". Only the modules of enabled skills are imported.
+
+    Parameters
+    ----------
+    settingsFile : str
+        Path to the global skill settings file
+    stateDataBase : statedb.StateDataBase
+        The shared state data base instance used for all skills
+
+    Returns
+    -------
+    list(skills.Skill) : the enabled skills
+    """
+    enabledSkills = skills.loadSettings(settingsFile).get(
+        "enabledSkills", defaultSkills)
+    skillList = []
+    for skill in enabledSkills:
+        moduleName, className = skill.rsplit(".", 1)
+        skillClass = getattr(importlib.import_module(moduleName), className)
+        skillList.append(
+            skillClass(statedb=stateDataBase, settingsFile=settingsFile))
+    return skillList
+
+
+statedb = statedb.StateDataBase()
+skillList = loadSkills(jsonSettingsFile, statedb)
+# all skill tasks run on one scheduler thread instead of a thread per skill
+scheduler = skills.SkillScheduler()
+
+
 def startSkills():
     for skill in skillList:
-        skill.start()
-        time.sleep(10)
+        scheduler.add(skill)
+    # the stack size applies to threads started while it is set
+    defaultStackSize = threading.stack_size(skillThreadStackSize)
+    try:
+        scheduler.start()
+    finally:
+        threading.stack_size(defaultStackSize)
 
 
 def joinSkills():
-    for skill in skillList:
-        skill.join()
+    if scheduler.is_alive():
+        scheduler.join()
 
 
 def interruptSkills():
-    for skill in skillList:
-        skill.stopEvent.set()
+    skills.sharedStopEvent.set()
+    scheduler.stop()
 
 
 if __name__ == "__main__":
@@ -50,7 +89,7 @@ if __name__ == "__main__":
         print("terminating...")
         interruptSkills()
     except Exception:
-        print("Error... " + str(traceback.format_exc))
+        print("Error... " + traceback.format_exc())
     finally:
         joinSkills()
         print("Terminated")
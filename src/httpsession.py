@@ -0,0 +1,16 @@
+"""
+Shared HTTP session for home automation skills
+
+session is a requests.Session shared by all skills talking HTTP, so the
+connections to the hue bridge and the weather service are kept alive between
+the polling intervals instead of being opened for every request.
+
+Copyright (c) 2021 Timo Haeckel
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
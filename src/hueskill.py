@@ -9,7 +9,45 @@ Copyright (c) 2021 Timo Haeckel
 from skills import SkillWithState
 import colorsys
 import datetime
-from phue import Bridge
+import functools
+import json
+import time
+import requests
+import httpsession
+from phue import Bridge, PhueException, PhueRequestTimeout
+
+
+class SessionBridge(Bridge):
+    """ A phue Bridge sending its requests through the shared http session
+
+    phue opens a new connection for every request to the bridge, this bridge 
+    keeps the connection alive using httpsession.session.
+    """
+    def request(self, mode='GET', address=None, data=None):
+        """ Sends a request to the bridge API and returns the json result
+
+        Parameters
+        ----------
+        mode : str
+            The HTTP method (GET, PUT, POST, or DELETE)
+        address : str
+            The API path of the request
+        data : json
+            The body for PUT and POST requests
+        """
+        body = None
+        if mode == 'PUT' or mode == 'POST':
+            body = json.dumps(data)
+        url = "http://" + self.ip + address
+        try:
+            response = httpsession.session.request(mode,
+                                                   url,
+                                                   data=body,
+                                                   timeout=10)
+        except requests.Timeout:
+            raise PhueRequestTimeout(
+                None, mode + " Request to " + url + " timed out.")
+        return response.json()
 
 
 class HueDaytimeAndWeatherSkill(SkillWithState):
@@ -38,7 +76,7 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
         A prefix used to access the daytime state
     WEATHER_STATE_PREFIX : str
         A prefix used to access the weather state
-    hue : Bridge()
+    hue : SessionBridge()
         The hue bridge access
     sceneNightMode : str
         Name of the scene that shall be activated during the night
@@ -56,6 +94,24 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
         Time for transition between scenes in .1 seconds (e.g., 300 = 30sec)
     lastModeSet : str
         on of the static modes below
+    lightIds : dict(str, str)
+        Cached hue light ids by light name
+    lightToRoom : dict(str, str)
+        Cached room names by light name for all lightsToAutomate
+    lightCacheRebuilt : bool
+        True if the light caches were rebuilt during the current task run, 
+        lights missing after that are not looked up again until the next run
+    lastInputs : tuple
+        The daytime and weather inputs of the last successful task run
+    bridgeBackoff : int
+        Number of intervals to wait after the next failed bridge request
+    bridgeNextAttempt : float
+        The time.monotonic() timestamp before which the bridge is not 
+        contacted after a failed request
+    MAX_BRIDGE_BACKOFF : int
+        Maximum number of intervals to wait between bridge requests
+    daytimeHandlers : tuple(function)
+        The mode handler for each daytime, indexed by daytimeskill.Daytime
     """
     MODE_SLEEP = "SLEEP"
     MODE_DAY_CLEAR = "DAY_CLEAR"
@@ -64,6 +120,7 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
     MODE_SUNRISE = "SUNRISE"
     MODE_SUNSET = "SUNSET"
     MODE_NIGHT = "NIGHT"
+    MAX_BRIDGE_BACKOFF = 64
 
     def __init__(self, statedb, settingsFile=""):
         """ 
@@ -83,7 +140,7 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
             "daytimeStatePrefix", "Weather")
         self.WEATHER_STATE_PREFIX = self.findSkillSettingWithKeyOrDefault(
             "weatherStatePrefix", "Daytime")
-        self.hue = Bridge(self.findSkillSettingWithKey("hueBridgeIp"))
+        self.hue = SessionBridge(self.findSkillSettingWithKey("hueBridgeIp"))
         self.lightsToAutomate = self.findSkillSettingWithKeyOrDefault(
             "lightsToAutomate", [])
         self.sceneNightMode = self.findSkillSettingWithKeyOrDefault(
@@ -99,30 +156,102 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
         self.sceneTransitionTime = self.findSkillSettingWithKeyOrDefault(
             "sceneTransitionTime", 300)
         self.lastModeSet = ""
+        self.lightIds = dict()
+        self.lightToRoom = dict()
+        self.lightCacheRebuilt = False
+        self.lastInputs = None
+        self.bridgeBackoff = 1
+        self.bridgeNextAttempt = 0.0
+        self.daytimeHandlers = (self.handleDayTime, self.handleSunriseTime,
+                                self.handleSunsetTime, self.handleNightTime)
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
     def convert_rgb_to_hue(rgbcolor):
+        """ Converts an rgb color to a hue color
+
+        Results are cached, as scenes only use a handful of colors.
+
+        Parameters
+        ----------
+        rgbcolor : tuple(int, int, int)
+            The rgb color, must be a tuple to be cacheable
+
+        Returns
+        -------
+        tuple(int, int, int) : the hue, saturation and brightness
+        """
         hsvcolor = colorsys.rgb_to_hsv(rgbcolor[0], rgbcolor[1], rgbcolor[2])
         huecolor = (int(hsvcolor[0] * 65535), int(hsvcolor[1] * 255),
                     int(hsvcolor[2]))
         return huecolor
 
-    def turnLightsOff(self):
+    def isLightReachable(self, light, lights):
+        """ Checks if a light is reachable in a dump of all light states
+
+        Parameters
+        ----------
+        light : str
+            The name of the light to check
+        lights : dict(str, dict)
+            The states of all lights by id as returned by Bridge.get_light()
+
+        Returns
+        -------
+        bool : True if the light is known and reachable
+        """
+        if light not in self.lightIds and not self.lightCacheRebuilt:
+            self.buildLightRoomCache()
+        lightId = self.lightIds.get(light)
+        return lightId in lights and lights[lightId]["state"]["reachable"]
+
+    def turnLightsOff(self, lights=None):
         """ Turns all lightsToAutomate off
 
         Sets the state of all lights in lightsToAutomate to off
+
+        Parameters
+        ----------
+        lights : dict(str, dict)
+            The states of all lights by id as returned by Bridge.get_light(), 
+            fetched from the bridge if not given
         """
-        if len(self.lightsToAutomate) > 0:
+        if self.lightsToAutomate:
+            if lights is None:
+                lights = self.hue.get_light()
             for light in self.lightsToAutomate:
-                if not self.hue.get_light(light)["state"]["reachable"]:
+                if not self.isLightReachable(light, lights):
                     self.log("Light " + light + " unreachable ")
                 else:
-                    self.hue.set_light(light, "on", False)
+                    self.hue.set_light(int(self.lightIds[light]), "on", False)
                     self.log("Turned light " + light + " off")
 
+    def buildLightRoomCache(self):
+        """ Builds the light id and room caches for all lightsToAutomate
+
+        Fetches all lights and all groups from the bridge once and stores the 
+        light ids in lightIds and the name of the first room containing each 
+        of the lightsToAutomate in lightToRoom. The caches are rebuilt at 
+        most once per task run.
+        """
+        lights = self.hue.get_light()
+        self.lightIds = {info['name']: id for id, info in lights.items()}
+        groups = self.hue.get_group().values()
+        self.lightToRoom = dict()
+        for light in self.lightsToAutomate:
+            lightId = self.lightIds.get(light)
+            for info in groups:
+                if lightId in info['lights']:
+                    self.lightToRoom[light] = info['name']
+                    break
+        self.lightCacheRebuilt = True
+
     def getRoomForLightName(self, light):
         """ Get a room from the light name
 
         Looks for the light name in all rooms and returns the name of the first room containing the light.
+        The rooms are cached, the cache is rebuilt once per task run if the 
+        light is not found in it.
 
         Parameters
         ----------
@@ -133,13 +262,11 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
         -------
         str : the name of the room the light belongs to, None if no room is found 
         """
-        lightId = self.hue.get_light_id_by_name(light)
-        for info in self.hue.get_group().values():
-            if lightId in info['lights']:
-                return info['name']
-        return None
+        if light not in self.lightToRoom and not self.lightCacheRebuilt:
+            self.buildLightRoomCache()
+        return self.lightToRoom.get(light)
 
-    def setScene(self, scene):
+    def setScene(self, scene, lights=None):
         """ Sets a scene for all rooms containing one of lightsToAutomate
         
         Looks for all rooms containing lightsToAutomate and sets the given scene with the transition time in self.sceneTransitionTime.
@@ -148,10 +275,15 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
         ----------
         scene : str
             The name of the hue scene to be set
+        lights : dict(str, dict)
+            The states of all lights by id as returned by Bridge.get_light(), 
+            fetched from the bridge if not given
         """
-        if len(self.lightsToAutomate) > 0:
+        if self.lightsToAutomate:
+            if lights is None:
+                lights = self.hue.get_light()
             for light in self.lightsToAutomate:
-                if not self.hue.get_light(light)["state"]["reachable"]:
+                if not self.isLightReachable(light, lights):
                     self.log("Light " + light + " unreachable ")
                 else:
                     self.hue.run_scene(
@@ -183,11 +315,117 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
         """
         self.log("Sunset mode not implemented yet")
 
-    def task(self):
+    def handleBedTime(self, weather):
+        """ Activates the sleep mode if not already set
+
+        Parameters
+        ----------
+        weather : wheatherskill.WeatherState
+            The current weather state
+        """
+        if not self.lastModeSet == self.MODE_SLEEP:
+            self.log("Setting bedtime sleep mode...")
+            self.activateSleepMode()
+            self.lastModeSet = self.MODE_SLEEP
+
+    def handleDayTime(self, weather):
+        """ Activates the day mode matching the clouds if not already set
+
+        Parameters
+        ----------
+        weather : wheatherskill.WeatherState
+            The current weather state
+        """
+        clouds = weather.getClouds()
+        if clouds < self.maxCloudsClear:
+            if not self.lastModeSet == self.MODE_DAY_CLEAR:
+                self.log("Setting clear day mode...")
+                self.turnLightsOff()
+                self.lastModeSet = self.MODE_DAY_CLEAR
+        elif clouds > self.minCloudsCloudy or weather.isRaining():
+            if not self.lastModeSet == self.MODE_DAY_DARK:
+                self.log("Setting dark day mode...")
+                self.setScene(self.sceneDayModeDark)
+                self.lastModeSet = self.MODE_DAY_DARK
+        else:
+            if not self.lastModeSet == self.MODE_DAY_MODERATE:
+                self.log("Setting light day mode...")
+                self.setScene(self.sceneDayModeLight)
+                self.lastModeSet = self.MODE_DAY_MODERATE
+
+    def handleSunriseTime(self, weather):
+        """ Activates the sunrise mode if not already set
+
+        Parameters
+        ----------
+        weather : wheatherskill.WeatherState
+            The current weather state
+        """
+        if not self.lastModeSet == self.MODE_SUNRISE:
+            self.log("Setting sunrise mode...")
+            self.activateSunriseMode()
+            self.lastModeSet = self.MODE_SUNRISE
+
+    def handleSunsetTime(self, weather):
+        """ Activates the sunset mode if not already set
+
+        Parameters
+        ----------
+        weather : wheatherskill.WeatherState
+            The current weather state
+        """
+        if not self.lastModeSet == self.MODE_SUNSET:
+            self.log("Setting sunset mode...")
+            self.activateSunsetMode()
+            self.lastModeSet = self.MODE_SUNSET
+
+    def handleNightTime(self, weather):
+        """ Activates the night mode if not already set
+
+        Parameters
+        ----------
+        weather : wheatherskill.WeatherState
+            The current weather state
+        """
+        if not self.lastModeSet == self.MODE_NIGHT:
+            self.log("Setting night mode...")
+            self.setScene(self.sceneNightMode)
+            self.lastModeSet = self.MODE_NIGHT
+
+    def activateMode(self, daytime, weather):
+        """ Activates the mode matching the daytime and weather
+
+        Activates the mode for the daytime and weather state if it is not 
+        already the lastModeSet, using the handler for the daytime from 
+        daytimeHandlers.
+
+        Parameters
+        ----------
+        daytime : daytimeskill.DaytimeState
+            The current daytime state
+        weather : wheatherskill.WeatherState
+            The current weather state
+        """
+        if daytime.bedTime:
+            self.handleBedTime(weather)
+        else:
+            self.daytimeHandlers[daytime.daytime](weather)
+
+    def task(self, now=None):
         """ Adapts hue lights to changes in daytime and weather
 
         This function will adapt the light to changes in the daytime and weather data.
+        If the bridge cannot be reached, further attempts are skipped for an 
+        exponentially growing number of intervals.
+
+        Parameters
+        ----------
+        now : float
+            The time.time() timestamp of the current run, not used by this 
+            skill
         """
+        if time.monotonic() < self.bridgeNextAttempt:
+            return
         weather = self.readState(self.WEATHER_STATE_PREFIX)
         daytime = self.readState(self.DAYTIME_STATE_PREFIX)
         if daytime is None:
@@ -196,42 +434,22 @@ class HueDaytimeAndWeatherSkill(SkillWithState):
         if weather is None:
             self.log("WeatherState not avialable ")
             return
+        inputs = (daytime.daytime, daytime.bedTime, weather.getClouds(),
+                  weather.isRaining())
+        if inputs == self.lastInputs:
+            return
 
-        if daytime.isBedTime():
-            if not self.lastModeSet == self.MODE_SLEEP:
-                self.log("Setting bedtime sleep mode...")
-                self.activateSleepMode()
-                self.lastModeSet = self.MODE_SLEEP
-        else:
-            if daytime.isDayTime():
-                if weather.getClouds() < self.maxCloudsClear:
-                    if not self.lastModeSet == self.MODE_DAY_CLEAR:
-                        self.log("Setting clear day mode...")
-                        self.turnLightsOff()
-                        self.lastModeSet = self.MODE_DAY_CLEAR
-                elif weather.getClouds(
-                ) > self.minCloudsCloudy or weather.isRaining():
-                    if not self.lastModeSet == self.MODE_DAY_DARK:
-                        self.log("Setting dark day mode...")
-                        self.setScene(self.sceneDayModeDark)
-                        self.lastModeSet = self.MODE_DAY_DARK
-                else:
-                    if not self.lastModeSet == self.MODE_DAY_MODERATE:
-                        self.log("Setting light day mode...")
-                        self.setScene(self.sceneDayModeLight)
-                        self.lastModeSet = self.MODE_DAY_MODERATE
-            elif daytime.isSunriseTime():
-                if not self.lastModeSet == self.MODE_SUNRISE:
-                    self.log("Setting sunrise mode...")
-                    self.activateSunriseMode()
-                    self.lastModeSet = self.MODE_SUNRISE
-            elif daytime.isSunsetTime():
-                if not self.lastModeSet == self.MODE_SUNSET:
-                    self.log("Setting sunset mode...")
-                    self.activateSunsetMode()
-                    self.lastModeSet = self.MODE_SUNSET
-            elif daytime.isNightTime():
-                if not self.lastModeSet == self.MODE_NIGHT:
-                    self.log("Setting night mode...")
-                    self.setScene(self.sceneNightMode)
-                    self.lastModeSet = self.MODE_NIGHT
+        self.lightCacheRebuilt = False
+        try:
+            self.activateMode(daytime, weather)
+        except (OSError, PhueException):
+            self.error("Hue bridge request failed, retrying in " +
+                       str(self.bridgeBackoff * self.interval) + "s ",
+                       exc=True)
+            self.bridgeNextAttempt = time.monotonic(
+            ) + self.bridgeBackoff * self.interval
+            self.bridgeBackoff = min(self.bridgeBackoff * 2,
+                                     self.MAX_BRIDGE_BACKOFF)
+            return
+        self.bridgeBackoff = 1
+        self.lastInputs = inputs
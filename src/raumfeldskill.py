@@ -8,6 +8,7 @@ Copyright (c) 2021 Timo Haeckel
 
 from skills import SkillWithState
 import raumfeld
+import sys
 
 RAUMFELD_URI_PLACEHOLDER = "dlna-playcontainer://uuid%3Abd4f7f00-aa40-4e4a-a54e-ec64e9944e23?sid=urn%3Aupnp-org%3AserviceId%3AContentDirectory&amp;cid=0%2FTidal%2FDirectAccess%2FArtist%2F8372%2FTopTracks&amp;fid=0&amp;fii=0"
 
@@ -16,11 +17,14 @@ class RaumfeldTVWakeup(SkillWithState):
     """ Skill to wakeup a raumfeld speaker connected to a smart tv.
 
     This skill wakes up the raumfeld speaker connected to the smart tv when it
-    is turned on.
+    is turned on. It observes the tv presence state of the 
+    DetectDevicePresenceSkill, so with an interval of 0 it only runs when the
+    tv state is updated.
 
     Settings
     --------
     {
+        "interval" : 0,
         "statePrefix" : "DevicePresence:",
         "tvAddress" : "192.168.178.42",
         "tvSpeakerRoomName" : "TV Speaker"
@@ -33,6 +37,16 @@ class RaumfeldTVWakeup(SkillWithState):
     STATE_PREFIX : str
         The prefix from the DeviceDetectionSkill used to form the state key in 
         the state data base for the tv host with STATE_PREFIX + Address  
+    tvStateKey : str
+        The state key of the tv presence state, STATE_PREFIX + tvAddress, 
+        None if no tvAddress is set
+    room : raumfeld.Room
+        The raumfeld room of the speaker, None until it is discovered
+    tvPresent : bool
+        The last tv presence received from the state data base, None until 
+        the first update
+    TRANSITIONS : dict(tuple(bool, bool), function)
+        The action for each (alreadyAwake, tvPresent) pair that needs one
     """
     def __init__(self, statedb, settingsFile=""):
         """ 
@@ -50,29 +64,88 @@ class RaumfeldTVWakeup(SkillWithState):
                                 settingsFile=settingsFile)
         raumfeld.init()
         self.alreadyAwake = False
-        self.speaker = self.findSkillSettingWithKey("tvSpeakerRoomName")
-        self.tvAddress = self.findSkillSettingWithKey("tvAddress")
-        self.STATE_PREFIX = self.findSkillSettingWithKey("statePrefix")
+        self.room = None
+        self.tvPresent = None
+        self.speaker, self.tvAddress, self.STATE_PREFIX = \
+            self.findSkillSettingsWithKeys(
+                ["tvSpeakerRoomName", "tvAddress", "statePrefix"])
+        if self.STATE_PREFIX is None:
+            self.STATE_PREFIX = "DevicePresence:"
+        self.tvStateKey = None
+        if self.tvAddress is None:
+            self.error("No tvAddress set, the TV speaker is never woken up")
+        else:
+            self.tvStateKey = sys.intern(self.STATE_PREFIX + self.tvAddress)
+            self.observeState(self.tvStateKey)
+
+    def stateChangedCallback(self, stateName, stateValue):
+        """ Stores the updated tv presence and wakes the skill up.
+
+        The speaker is not woken up here, the callback runs in the thread of 
+        the DetectDevicePresenceSkill and must not block on the network.
+
+        Parameters
+        ----------
+        stateName : str
+            The name of the state that is used as a key
+        stateValue : devicedetectionskill.DevicePresenceState
+            The presence state of the tv
+        """
+        self.tvPresent = stateValue.currentlyPresent
+        self.wake()
 
     def wakeup(self, speaker):
-        rooms = raumfeld.getRoomsByName(speaker)
-        rooms[0].play(RAUMFELD_URI_PLACEHOLDER)
-        rooms[0].pause()
+        """ Wakes up the speaker by starting and pausing playback
+
+        The room of the speaker is discovered on the first wakeup and reused 
+        afterwards. If no room is found or the room fails to play, it is 
+        looked up again next time.
+
+        Parameters
+        ----------
+        speaker : str
+            The name of the raumfeld room of the speaker
+        """
+        if self.room is None:
+            self.room = raumfeld.getRoomsByName(speaker)[0]
+        try:
+            # two requests, the raumfeld library has no call to send both
+            self.room.play(RAUMFELD_URI_PLACEHOLDER)
+            self.room.pause()
+        except Exception:
+            # the cached room may be stale, discover it again next time
+            self.room = None
+            raise
+
+    def tvTurnedOn(self):
+        """ Wakes up the TV speaker when the tv was turned on.
+        """
+        self.wakeup(self.speaker)
+        self.alreadyAwake = True
+        self.log("TV Speaker woken up")
+
+    def tvTurnedOff(self):
+        """ Allows the TV speaker to sleep when the tv was turned off.
+        """
+        self.alreadyAwake = False
+        self.log("TV turned off sleep allowed")
+
+    # transitions by (alreadyAwake, tvPresent), all others need no action
+    TRANSITIONS = {(False, True): tvTurnedOn, (True, False): tvTurnedOff}
 
-    def task(self):
+    def task(self, now=None):
         """ Wakeup TV speakers task
 
-        This function will wakeup the TV speakers if the TV device is turned on
+        This function will wakeup the TV speakers if the TV device is turned on.
+        It uses the tv presence received in stateChangedCallback, so the 
+        state data base is not polled.
+
+        Parameters
+        ----------
+        now : float
+            The time.time() timestamp of the current run, not used by this 
+            skill
         """
-        tvState = self.readState(self.STATE_PREFIX + self.tvAddress)
-        if tvState is not None:
-            if tvState.currentlyPresent:
-                #tv is turned on!
-                if not self.alreadyAwake:
-                    self.wakeup(self.speaker)
-                    self.alreadyAwake = True
-                    self.log("TV Speaker woken up")
-            elif self.alreadyAwake:
-                #tv turned off!
-                self.alreadyAwake = False
-                self.log("TV turned off sleep allowed")
+        transition = self.TRANSITIONS.get((self.alreadyAwake, self.tvPresent))
+        if transition is not None:
+            transition(self)
@@ -3,22 +3,75 @@ Base implementations for home automation skills
 
 Skill class implements a thread with a task executed every interval.
 SkillWithState implements a Skill with a connection to the state data base.
+SkillScheduler implements a single thread running the tasks of many skills.
 
 Copyright (c) 2021 Timo Haeckel
 """
 
-from threading import Thread, Event
-import sys
+from threading import Thread, Event, Condition, Lock
 import traceback
-import datetime
+import heapq
+import itertools
+import time
 import json
+import os
+import sys
 import statedb
 
 
+class StopEvent(Event):
+    """ An event that wakes up all running skills using it when it is set.
+
+    Skills only wait for their wake event, so setting a plain Event would 
+    not be noticed by a skill waiting for its next run.
+
+    Attributes
+    ----------
+    skills : set(Skill)
+        The running skills stopped by this event
+    skillsLock : threading.Lock
+        Protects skills
+    """
+    def __init__(self):
+        Event.__init__(self)
+        self.skills = set()
+        self.skillsLock = Lock()
+
+    def register(self, skill):
+        """ Adds a running skill to be woken up when the event is set.
+        """
+        with self.skillsLock:
+            self.skills.add(skill)
+
+    def unregister(self, skill):
+        """ Removes a skill that is not running anymore.
+        """
+        with self.skillsLock:
+            self.skills.discard(skill)
+
+    def set(self):
+        """ Sets the event and wakes up all registered skills.
+        """
+        Event.set(self)
+        with self.skillsLock:
+            skills = tuple(self.skills)
+        for skill in skills:
+            skill.wake()
+
+
+# stop event of all skills not given their own, set once on shutdown
+sharedStopEvent = StopEvent()
+# parsed settings files by their real path, shared by all skills
+loadedSettings = dict()
+
+
 def findKeyInJson(jsonDict, searchKey):
     """ Search for recursive for a key in a JSON dictionary.
 
     General purpose function to look for a key in a json file.
+    The nested dictionaries are walked with an explicit stack instead of 
+    recursion. A key on an outer level is found before the same key on an 
+    inner level.
 
     Parameters
     ----------
@@ -32,18 +85,78 @@ def findKeyInJson(jsonDict, searchKey):
     value : jsonObject
         The json object that is found behind the searchKey.
     """
-    for key in jsonDict:
-        value = jsonDict[key]
-        if key == searchKey:
-            return value
-        elif isinstance(value, dict):
-            #launch recursion
-            inner = findKeyInJson(value, searchKey)
-            if inner is not None:
-                return inner
+    stack = [jsonDict]
+    while stack:
+        current = stack.pop()
+        if searchKey in current:
+            return current[searchKey]
+        # push reversed to visit the inner dictionaries in file order
+        for value in reversed(list(current.values())):
+            if isinstance(value, dict):
+                stack.append(value)
     return None
 
 
+def findKeysInJson(jsonDict, searchKeys):
+    """ Search for several keys in a JSON dictionary in a single walk.
+
+    Finds the same values as calling findKeyInJson for every key, but the 
+    nested dictionaries are only walked once. The walk ends as soon as all 
+    keys are found.
+
+    Parameters
+    ----------
+    jsonDict : dict()
+        Dictionary containing a json structure
+    searchKeys : list(str)
+        The keys to look for in the settings
+
+    Returns
+    -------
+    values : dict(str, jsonObject)
+        The json objects found behind the keys, missing keys are left out.
+    """
+    remaining = set(searchKeys)
+    values = dict()
+    stack = [jsonDict]
+    while stack and remaining:
+        current = stack.pop()
+        for searchKey in remaining.intersection(current):
+            values[searchKey] = current[searchKey]
+        remaining.difference_update(values)
+        # push reversed to visit the inner dictionaries in file order
+        for value in reversed(list(current.values())):
+            if isinstance(value, dict):
+                stack.append(value)
+    return values
+
+
+def loadSettings(settingsFile):
+    """ Loads a json settings file once per process.
+
+    All skills are usually created from the same settings file. The file is 
+    parsed by the first skill and the same dictionary is returned to all 
+    others, so it must not be modified.
+
+    Parameters
+    ----------
+    settingsFile : str
+        Path to the global skill settings file
+
+    Returns
+    -------
+    settings : dict()
+        The parsed json settings
+    """
+    path = os.path.realpath(settingsFile)
+    settings = loadedSettings.get(path)
+    if settings is None:
+        with open(path) as settingsFp:
+            settings = json.load(settingsFp)
+        loadedSettings[path] = settings
+    return settings
+
+
 class Skill(Thread):
     """
     Settings
@@ -56,6 +169,7 @@ class Skill(Thread):
         },
         "SKILLNAME" : {
             "interval" : 60,
+            "startDelay" : 0,
             "setting1" : "value",
             "setting2" : [
                 "value",
@@ -64,7 +178,13 @@ class Skill(Thread):
         }
     }
     """
-    def __init__(self, name, settingsFile=""):
+    # Thread instances keep their __dict__ and name stays in it, the
+    # attributes read on every task and log call are slots.
+    __slots__ = ("stopEvent", "wakeEvent", "scheduler", "settingCache",
+                 "settings", "skillSettings", "interval", "startDelay",
+                 "errorSilent", "logSilent", "logFile", "logFp")
+
+    def __init__(self, name, settingsFile="", stopEvent=None):
         """ 
         Parameters
         ----------
@@ -72,22 +192,49 @@ class Skill(Thread):
             The name of the skill
         settingsFile : str
             Path to the global skill settings file.
+        stopEvent : threading.Event
+            Event that stops the skill when set, sharedStopEvent if None. 
+            Setting a StopEvent wakes up all running skills using it, a 
+            plain Event only stops a waiting skill once it wakes up.
         """
         Thread.__init__(self)
         self.name = name
-        self.stopEvent = Event()
-        if len(settingsFile) > 0:
-            settings = open(settingsFile)
-            self.settings = json.load(settings)
+        if stopEvent is None:
+            stopEvent = sharedStopEvent
+        self.stopEvent = stopEvent
+        self.wakeEvent = Event()
+        self.scheduler = None
+        self.settingCache = dict()
+        if settingsFile:
+            self.settings = loadSettings(settingsFile)
         else:
-            self.settings = ""
+            self.settings = None
+        # the settings of this skill, searched for every setting key
+        self.skillSettings = None
+        if self.settings:
+            self.skillSettings = findKeyInJson(self.settings, self.name)
 
         self.interval = self.findSkillSettingWithKeyOrDefault("interval", 60)
+        self.startDelay = self.findSkillSettingWithKeyOrDefault(
+            "startDelay", 0)
         self.errorSilent = self.findSkillSettingWithKeyOrDefault(
             "errorSilent", False)
         self.logSilent = self.findSkillSettingWithKeyOrDefault(
             "logSilent", False)
         self.logFile = self.findSkillSettingWithKeyOrDefault("logFile", "")
+        self.logFp = None
+        if self.logFile:
+            # line buffered, every message is written right away
+            self.logFp = open(self.logFile, 'a', buffering=1)
+
+    def isStopped(self):
+        """ Checks whether the stop event of this skill is set.
+
+        Returns
+        -------
+        Bool : True if the skill was stopped
+        """
+        return self.stopEvent.is_set()
 
     def findSkillSettingWithKeyOrDefault(self, settingKey, defaultValue):
         """ Uses findSkillSettingWithKey to find the value or returns defaultValue.
@@ -102,6 +249,9 @@ class Skill(Thread):
 
     def findSkillSettingWithKey(self, settingKey):
         """ Searches for the key in the skills json settings.
+
+        The settings do not change after loading, so the result for each key
+        is cached in settingCache.
         
         Parameters
         ----------
@@ -113,33 +263,79 @@ class Skill(Thread):
         value : jsonObject
             The json object that is found behind the searchKey.
         """
-        if len(self.settings) > 0:
-            skillSettings = findKeyInJson(self.settings, self.name)
-            return findKeyInJson(skillSettings, settingKey)
-        else:
-            return None
+        if settingKey in self.settingCache:
+            return self.settingCache[settingKey]
+        value = None
+        if self.skillSettings is not None:
+            value = findKeyInJson(self.skillSettings, settingKey)
+        self.settingCache[settingKey] = value
+        return value
+
+    def findSkillSettingsWithKeys(self, settingKeys):
+        """ Searches for several keys in the skills json settings at once.
+
+        Keys that were not looked up before are found in a single walk of the
+        settings and added to settingCache.
+
+        Parameters
+        ----------
+        settingKeys : list(str)
+            The keys to look for in the settings
+
+        Returns
+        -------
+        values : list(jsonObject)
+            The json objects found behind the keys in the order of the keys,
+            None for keys that are not found.
+        """
+        missingKeys = [
+            key for key in settingKeys if key not in self.settingCache
+        ]
+        if missingKeys:
+            found = dict()
+            if self.skillSettings is not None:
+                found = findKeysInJson(self.skillSettings, missingKeys)
+            for key in missingKeys:
+                self.settingCache[key] = found.get(key)
+        return [self.settingCache[key] for key in settingKeys]
 
     def printLog(self, text, level="INFO"):
         """ Prints a log message.
 
         Prints a log message with the current time, its level and the Skill
         name to a file if self.logFile is set, else the message is printed 
-        to the console. 
+        to the console. The log file is opened once and kept open until 
+        closeLog() is called.
  
         Parameters
         ----------
         text : str
             The log message to print
         """
-        if len(text) > 0:
-            printStr = str(
-                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ) + " (" + level + ") Skill " + self.name + ": " + text
-            if len(self.logFile) != 0:
-                print(printStr, file=open(self.logFile, 'a'))
+        if text:
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+            printStr = f"{timestamp} ({level}) Skill {self.name}: {text}"
+            if self.logFp is not None:
+                print(printStr, file=self.logFp)
             else:
-                print(printStr)
-        sys.stdout.flush()
+                print(printStr, flush=True)
+
+    def closeLog(self):
+        """ Closes the log file if one is open.
+
+        Further messages are printed to the console.
+        """
+        if self.logFp is not None:
+            self.logFp.close()
+            self.logFp = None
+
+    def close(self):
+        """ Releases the resources of the skill when it is terminated.
+
+        Override this function to close sockets or files opened by your 
+        skill, the default implementation closes the log file.
+        """
+        self.closeLog()
 
     def log(self, text):
         """ Prints a log message.
@@ -155,7 +351,7 @@ class Skill(Thread):
         if not self.logSilent:
             self.printLog(text=text, level="INFO")
 
-    def error(self, text=""):
+    def error(self, text="", exc=False):
         """ Prints an error message.
 
         Prints an error message if errorSilent is not set, using the 
@@ -165,37 +361,124 @@ class Skill(Thread):
         ----------
         text : str
             The error message to print
+        exc : bool
+            Append the traceback of the exception currently being handled
         """
         if not self.errorSilent:
-            self.printLog(text=text + str(traceback.format_exc), level="ERROR")
+            if exc:
+                text += "\n" + traceback.format_exc().rstrip()
+            self.printLog(text=text, level="ERROR")
+
+    def wake(self):
+        """ Wakes the skill up to run its task right away.
+
+        If the skill was added to a SkillScheduler, the scheduler runs its 
+        task next.
+        """
+        if self.scheduler is not None:
+            self.scheduler.wake(self)
+        else:
+            self.wakeEvent.set()
+
+    def stop(self):
+        """ Stops the skill, also if it is currently waiting.
+
+        Sets the stop event, so all skills sharing it are stopped. A 
+        StopEvent wakes up all of them, otherwise only this skill is woken.
+        """
+        self.stopEvent.set()
+        self.wake()
+
+    def attachStopEvent(self):
+        """ Registers the running skill to be woken up by its StopEvent.
+        """
+        if isinstance(self.stopEvent, StopEvent):
+            self.stopEvent.register(self)
+
+    def detachStopEvent(self):
+        """ Unregisters the skill from its StopEvent when it ends.
+        """
+        if isinstance(self.stopEvent, StopEvent):
+            self.stopEvent.unregister(self)
+
+    def waitUntil(self, deadline):
+        """ Waits until the deadline is reached or the skill is woken up.
+
+        Parameters
+        ----------
+        deadline : float
+            The time.monotonic() timestamp to wait for, None to wait until 
+            the skill is woken up
+
+        Returns
+        -------
+        Bool : True if the skill was stopped while waiting
+        """
+        if deadline is None:
+            self.wakeEvent.wait()
+        else:
+            self.wakeEvent.wait(max(0, deadline - time.monotonic()))
+        self.wakeEvent.clear()
+        return self.isStopped()
 
     def run(self):
         """ Run function of the Skill !NOT ITS TASK!
 
-        This function runs the Skill task every interval. The run function
-        is stopped whend the stopEvent is set. Please override the task() 
-        function for your skill implementation not this function.
+        This function runs the Skill task every interval, the first time 
+        after startDelay seconds. The run function is stopped whend stop() 
+        is called. Please override the task() function for your skill 
+        implementation not this function.
+        The next run is scheduled relative to the start of the previous one,
+        so the time spent in task() does not add up as drift. Runs that were 
+        missed because a task took longer than the interval are skipped.
+        The task also runs whenever the skill is woken up with wake(). With 
+        an interval of 0 the task only runs when the skill is woken up.
         """
         self.log("skill launched with interval " + str(self.interval))
-        while not self.stopEvent.is_set():
-            try:
-                self.task()
-                self.stopEvent.wait(self.interval)
-            except KeyboardInterrupt:
-                continue
-            except Exception:
-                self.error("task failed ")
+        self.attachStopEvent()
+        stopped = self.waitUntil(time.monotonic() + self.startDelay)
+        deadline = time.monotonic()
+        while not stopped:
+            self.runTask()
+            if self.interval <= 0:
+                deadline = None
+            elif deadline <= time.monotonic():
+                deadline = max(deadline + self.interval, time.monotonic())
+            # waitUntil reports a stop, no extra check of the stop event
+            stopped = self.waitUntil(deadline)
+        self.detachStopEvent()
         self.log("skill terminated ")
+        self.close()
+
+    def runTask(self):
+        """ Runs the task once and logs the error if it fails.
 
-    def task(self):
+        Used by run() and by the SkillScheduler, so a failing task does not 
+        stop the thread running it.
+        """
+        try:
+            self.task(now=time.time())
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            self.error("task failed ", exc=True)
+
+    def task(self, now=None):
         """ The task of the Skill.
 
         This function shall be overwritten with the implementation of the 
         Skill itself. It is called by the run function of this Skill every
         interval. 
+
+        Parameters
+        ----------
+        now : float
+            The time.time() timestamp of the current run, so the task does 
+            not have to fetch the time again. None if called outside of run.
         """
-        self.log("No task implemented for this skill ...stopping")
-        self.stopEvent.set()
+        self.log("No task implemented for this skill ...pausing")
+        # setting the shared stop event would stop all skills
+        self.interval = 0
 
 
 class SkillWithState(Skill, statedb.StateDataBaseObserver):
@@ -203,7 +486,8 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
 
     An abstract implementation extending a basic Skill with 
     a connection to the global state data base instance. 
-    Provides functions to updateState, readState, and observeState.
+    Provides functions to updateState, updateStates, readState, and 
+    observeState.
     The function stateChangedCallback() shall be overwritten to
     react on observed state changes.
 
@@ -213,7 +497,9 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
         Reference to the shared state data base instance used for 
         all skills in the home automation setup
     """
-    def __init__(self, name, statedb, settingsFile=""):
+    __slots__ = ("statedb", )
+
+    def __init__(self, name, statedb, settingsFile="", stopEvent=None):
         """ 
         Parameters
         ----------
@@ -224,8 +510,13 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
             the home automation setup
         settingsFile : str
             Path to the global skill settings file
+        stopEvent : threading.Event
+            Event that stops the skill when set, sharedStopEvent if None
         """
-        Skill.__init__(self, name=name, settingsFile=settingsFile)
+        Skill.__init__(self,
+                       name=name,
+                       settingsFile=settingsFile,
+                       stopEvent=stopEvent)
         self.statedb = statedb
 
     def stateChangedCallback(self, stateName, stateValue):
@@ -235,6 +526,9 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
         at the stateDataBase and is called when ever an obeserved state 
         variable is updated. Overide this method and parse the stateName 
         and stateValue accordingly.   
+        The default implementation wakes the skill up, so its task runs 
+        right away. The callback runs in the thread of the skill updating the
+        state, so it should not block.
 
         Parameters
         ----------
@@ -243,8 +537,7 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
         stateValue : complex type
             The value of the state which can be of any complex type    
         """
-        self.log("Received unhandled notification for " + stateName +
-                 " with value " + stateValue)
+        self.wake()
 
     def observeState(self, stateName):
         """ Register for notifications if the given state changes.
@@ -257,14 +550,15 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
         stateName : str
             The name of the state that is used as a key an shall be observed
         """
-        if len(stateName) > 0:
-            self.statedb.registerCallback(stateName, self.stateChangedCallback)
+        if stateName:
+            self.statedb.registerObserver(sys.intern(stateName), self)
 
     def updateState(self, stateName, stateValue):
         """ Updates the given state with the given value.
         
         Updates the state with the key stateName in the state data base 
-        with the new value of stateValue.
+        with the new value of stateValue. State names are interned, so the 
+        state data base compares the keys by identity.
 
         Parameters
         ----------
@@ -273,8 +567,26 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
         stateValue : complex type
             The value of the state which can be of any complex type
         """
-        if len(stateName) > 0:
-            self.statedb.setState(stateName, stateValue)
+        if stateName:
+            self.statedb.setState(sys.intern(stateName), stateValue)
+
+    def updateStates(self, states):
+        """ Updates several states at once.
+
+        Updates all states in the state data base with a single lock, use it 
+        instead of updateState when a task updates many states.
+
+        Parameters
+        ----------
+        states : dict(str, complex type)
+            The values of the states which can be of any complex type by the 
+            name of the state
+        """
+        if states:
+            self.statedb.setStates({
+                sys.intern(stateName): stateValue
+                for stateName, stateValue in states.items()
+            })
 
     def readState(self, stateName):
         """ Reads the value of the given state.
@@ -293,4 +605,140 @@ class SkillWithState(Skill, statedb.StateDataBaseObserver):
             The value of the state which can be of any complex type
             None if the state does not exist
         """
-        return self.statedb.getState(stateName)
+        return self.statedb.getState(sys.intern(stateName))
+
+
+class SkillScheduler(Thread):
+    """ A single thread running the tasks of many skills.
+
+    Most skills are idle almost all of the time, so instead of starting a 
+    thread for every skill the skills can be added to a scheduler. The 
+    scheduler keeps the next run of every skill in a heap and sleeps until 
+    the earliest one is due. Skills are run one after another, so a task 
+    should not block for long. Waking a skill up schedules it right away, a 
+    skill with an interval of 0 only runs when it is woken up.
+
+    Attributes
+    ----------
+    skills : list(Skill)
+        The skills that are run by this scheduler and not stopped yet
+    queue : list(tuple(float, int, Skill))
+        Heap of the scheduled runs as time.monotonic() deadline, insertion 
+        counter and skill. Entries that do not match deadlines are outdated 
+        and dropped when they reach the top.
+    deadlines : dict(Skill, float)
+        The deadline of the next run of every scheduled skill
+    condition : threading.Condition
+        Protects the queue and is notified when it changes
+    """
+    def __init__(self):
+        Thread.__init__(self, name="SkillScheduler")
+        self.skills = []
+        self.queue = []
+        self.deadlines = dict()
+        self.counter = itertools.count()
+        self.condition = Condition()
+        self.stopped = False
+
+    def add(self, skill):
+        """ Adds a skill, its task runs the first time after startDelay.
+
+        Parameters
+        ----------
+        skill : Skill
+            The skill to run, it must not be started as a thread itself
+        """
+        skill.scheduler = self
+        with self.condition:
+            self.skills.append(skill)
+            self.schedule(skill, time.monotonic() + skill.startDelay)
+        skill.attachStopEvent()
+        skill.log("skill launched with interval " + str(skill.interval))
+
+    def schedule(self, skill, deadline):
+        """ Schedules the next run of a skill, replacing an earlier one.
+
+        Must be called with the condition held.
+        """
+        self.deadlines[skill] = deadline
+        heapq.heappush(self.queue, (deadline, next(self.counter), skill))
+        self.condition.notify()
+
+    def wake(self, skill):
+        """ Runs the task of the skill as soon as possible.
+        """
+        with self.condition:
+            if skill in self.skills:
+                self.schedule(skill, time.monotonic())
+
+    def stop(self):
+        """ Stops the scheduler and all of its skills.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def nextDueSkill(self):
+        """ Waits until the next skill is due.
+
+        Returns
+        -------
+        tuple(Skill, float) : the skill and the deadline it was scheduled 
+            for, (None, None) if the scheduler was stopped
+        """
+        with self.condition:
+            while not self.stopped:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                deadline, _, skill = self.queue[0]
+                if self.deadlines.get(skill) != deadline:
+                    # outdated entry, the skill was rescheduled or finished
+                    heapq.heappop(self.queue)
+                    continue
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+                heapq.heappop(self.queue)
+                del self.deadlines[skill]
+                return skill, deadline
+        return None, None
+
+    def finish(self, skill):
+        """ Removes a stopped skill from the scheduler.
+        """
+        with self.condition:
+            if skill not in self.skills:
+                return
+            self.skills.remove(skill)
+            self.deadlines.pop(skill, None)
+        skill.detachStopEvent()
+        skill.log("skill terminated ")
+        skill.close()
+
+    def run(self):
+        """ Run function of the scheduler.
+
+        Runs the task of the next due skill and schedules its next run 
+        relative to the previous deadline, like Skill.run() does.
+        """
+        while True:
+            skill, deadline = self.nextDueSkill()
+            if skill is None:
+                break
+            if not skill.isStopped():
+                skill.runTask()
+            if skill.isStopped():
+                self.finish(skill)
+                continue
+            if skill.interval <= 0:
+                continue
+            with self.condition:
+                # a wake up during the task already scheduled the next run
+                if skill not in self.deadlines:
+                    self.schedule(
+                        skill,
+                        max(deadline + skill.interval, time.monotonic()))
+        for skill in list(self.skills):
+            self.finish(skill)
@@ -40,21 +40,26 @@ class StateDataBase:
     states : dict(str, complex type)
         Shared states of home automation skills 
         Key is the name of the state, the value can be of any complex type
-    observers : dict(str, list(StateDataBaseObserver))
+    observers : dict(str, tuple(function))
         Obeservers to be notified on state changes
-        Key is the name of the state, the value is a list of StateDataBaseObservers
+        Key is the name of the state, the value is a tuple of the bound 
+        stateChangedCallback methods of the StateDataBaseObservers. The tuple 
+        is replaced when an observer is registered, so it can be iterated 
+        without holding the mutex.
     mutex : threading.Lock
         Mutex to ensure thread safety for multiple skills accessing the states
     """
-    def __init__(self, initialStates=dict()):
+    def __init__(self, initialStates=None):
         """ 
         Parameters
         ----------
-        initialStates : dict(str, complex type) (Default empty dict)
+        initialStates : dict(str, complex type) (Default None)
             States that are to be set during initialization in the state data base
             Key is the name of the state, the value can be of any complex type
         """
-        self.states = initialStates
+        self.states = dict()
+        if initialStates is not None:
+            self.states.update(initialStates)
         self.observers = dict()
         self.mutex = Lock()
 
@@ -72,16 +77,14 @@ class StateDataBase:
             The value of the state which can be of any complex type
             None if the state does not exist
         """
-        value = None
-        if key in self.states:
-            value = self.states[key]
-        return value
+        return self.states.get(key)
 
     def setState(self, key, value):
         """ Sets the state of key with the given value.
         
         Updates the state with the key in the state data base with the new value
-        of stateValue.
+        of stateValue. The observers of the state are notified after the 
+        lock is released.
 
         Parameters
         ----------
@@ -90,17 +93,46 @@ class StateDataBase:
         value : complex type
             The value of the state to be set which can be of any complex type
         """
-        self.mutex.acquire()
-        if len(key) > 0:
+        if not key:
+            return
+        with self.mutex:
             self.states[key] = value
-            self.notifyObservers(key)
-        self.mutex.release()
+            observers = self.observers.get(key, ())
+        # notify outside the lock, a callback must not block other skills
+        for callback in observers:
+            callback(key, value)
+
+    def setStates(self, states):
+        """ Sets several states at once.
+
+        All states are updated while holding the lock once, the observers 
+        are notified afterwards in the order of the states.
+
+        Parameters
+        ----------
+        states : dict(str, complex type)
+            The values of the states to be set by the name of the state
+        """
+        notifications = []
+        with self.mutex:
+            for key, value in states.items():
+                if not key:
+                    continue
+                self.states[key] = value
+                observers = self.observers.get(key)
+                if observers:
+                    notifications.append((key, value, observers))
+        # notify outside the lock, a callback must not block other skills
+        for key, value, observers in notifications:
+            for callback in observers:
+                callback(key, value)
 
     def registerObserver(self, key, observer: StateDataBaseObserver):
         """ Register a callbackFct to notify when the state with the key changes.
 
         The stateChangedCallback of this skill is registered as an observer
-        function to be notified if the given state is updated.
+        function to be notified if the given state is updated. The state 
+        does not need to exist yet.
 
         Parameters
         ----------
@@ -109,11 +141,12 @@ class StateDataBase:
         observer : StateDataBaseObserver
             The obeserver to be registered for notifications
         """
-        if key in self.states:
-            if key not in self.observers:
-                self.observers[key] = []
-            if observer not in self.observers[key]:
-                self.observers[key].append(observer)
+        # the bound method is stored, so notifying needs no method lookup
+        callback = observer.stateChangedCallback
+        with self.mutex:
+            observers = self.observers.get(key, ())
+            if callback not in observers:
+                self.observers[key] = observers + (callback, )
 
     def notifyObservers(self, key):
         """ Notifies all registered callbacks that observe the state with the key.
@@ -125,6 +158,5 @@ class StateDataBase:
         key : str
             The name of the state
         """
-        if key in self.observers:
-            for observer in self.observers[key]:
-                observer.stateChangedCallback(key, self.states[key])
+        for callback in self.observers.get(key, ()):
+            callback(key, self.states.get(key))
@@ -8,7 +8,7 @@ Copyright (c) 2021 Timo Haeckel
 """
 
 from skills import SkillWithState
-import requests
+import httpsession
 import json
 
 
@@ -20,6 +20,8 @@ class WeatherState():
     raw : json
         Raw weather data json object from weather service
     """
+    __slots__ = ("raw", )
+
     def __init__(self, weatherData=None):
         self.raw = weatherData
 
@@ -52,13 +54,11 @@ class WeatherState():
 
 
 class WeatherSkill(SkillWithState):
-    """ Skill to detect devices present in the network.
+    """ Skill to fetch current weather information.
 
-    This skill sends ping probes to the device addresses to detect their 
-    presence. Remember that a host may not respond to a ping (ICMP) request
-    even if the host name is valid.
-    The DevicePresenceState() with the key STATE_PREFIX+ADDRESS will be
-    constantly updated.
+    This skill requests the current weather from a weather service, e.g., 
+    the openweathermap current weather API, every interval.
+    The WeatherState() with the key STATE_PREFIX will be constantly updated.
 
     Settings
     --------
@@ -69,11 +69,15 @@ class WeatherSkill(SkillWithState):
 
     Attributes
     ----------
-    addresses : list(str)
-        The device IPv4 addresses to be detected in the local network.
+    requestURL : str
+        The URL of the weather service request
     STATE_PREFIX : str
-        A prefix used to form the state key in the state data base with 
-        STATE_PREFIX + Address  
+        The key of the weather state in the state data base
+    etag : str
+        The ETag header of the last weather response, None if not sent
+    lastModified : str
+        The Last-Modified header of the last weather response, None if not 
+        sent
     """
     STATE_PREFIX = "Weather"
 
@@ -95,13 +99,40 @@ class WeatherSkill(SkillWithState):
         prefix = self.findSkillSettingWithKey("statePrefix")
         if prefix is not None:
             self.STATE_PREFIX = prefix
+        self.etag = None
+        self.lastModified = None
 
-    def task(self):
+    def task(self, now=None):
         """ Refreshes the weather information
 
         This function will refresh the weather information for a request url.
+        The connection to the weather service is kept alive between requests.
+        The request is conditional on the ETag and Last-Modified headers of 
+        the previous response, if the weather did not change the service 
+        answers 304 Not Modified and the state is left as it is.
         The weather json data with the key STATE_PREFIX will be updated.
+
+        Parameters
+        ----------
+        now : float
+            The time.time() timestamp of the current run, not used by this 
+            skill
         """
-        weather = requests.get(self.requestURL).json()
-        self.log("current weather:\n" + json.dumps(weather, indent=4))
+        headers = dict()
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified is not None:
+            headers["If-Modified-Since"] = self.lastModified
+        response = httpsession.session.get(self.requestURL,
+                                           headers=headers,
+                                           timeout=10)
+        if response.status_code == 304:
+            self.log("weather not modified")
+            return
+        weather = response.json()
+        if response.ok:
+            self.etag = response.headers.get("ETag")
+            self.lastModified = response.headers.get("Last-Modified")
+        if not self.logSilent:
+            self.log("current weather:\n" + json.dumps(weather, indent=4))
         self.updateState(self.STATE_PREFIX, WeatherState(weatherData=weather))